@@ -2,15 +2,18 @@ import streamlit as st
 import yfinance as yf
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from numba import njit, types
 import time
+import os
 from datetime import datetime
 import pytz
 import warnings
 import json
+import hashlib
 import gspread
+from streamlit_autorefresh import st_autorefresh
 from google.oauth2.service_account import Credentials
 
 warnings.filterwarnings("ignore")
@@ -18,6 +21,10 @@ warnings.filterwarnings("ignore")
 # --- PAGE CONFIGURATION ---
 # --- NEW CODE ---
 st.set_page_config(page_title="Indian Equities Bot", layout="wide")
+
+# The browser schedules the next cycle in 60s, so no server thread sleeps while holding the session.
+# Registered first so the page keeps refreshing even if something below raises.
+st_autorefresh(interval=60_000, key="equity_tick")
 # ---------------------------------------------------------
 # 1. GOOGLE SHEETS CLOUD STORAGE LOGIC
 # ---------------------------------------------------------
@@ -51,56 +58,87 @@ state_tab = sheet.worksheet("Equity_State")
 ledger_tab = sheet.worksheet("Equity_Ledger")
 
 
+def reset_positions():
+    """Flat book: one slot per pair in each array, indexed like `pairs`."""
+    st.session_state.positions = np.zeros(len(pairs), dtype=np.int8)  # 0 flat, 1 holding asset 1, 2 holding asset 2
+    st.session_state.held_units = np.zeros(len(pairs), dtype=np.int64)
+    st.session_state.entry_prices = np.zeros(len(pairs), dtype=np.float64)
+
+
 def load_cloud_state():
     """Pulls your capital and positions down from Google Sheets."""
+    reset_positions()
     try:
-        raw_data = state_tab.acell('A1').value
+        # One batched v4 values read; acell goes through the cell feed call path
+        cell = state_tab.batch_get(['A1'])[0]
+        raw_data = cell[0][0] if cell and cell[0] else None
         if raw_data:
             state_data = json.loads(raw_data)
             st.session_state.portfolio = state_data.get('portfolio', 1000000.0)
 
-            # Reconstruct the states dictionary
-            loaded_states = {}
-            for k, v in state_data.get('states', {}).items():
-                a1, a2 = k.split('|')
-                loaded_states[(a1, a2)] = v
-            st.session_state.states = loaded_states
+            saved = state_data.get('states', [])
+            if isinstance(saved, dict):
+                # Older saves stored a dict per pair, keyed "A1|A2"
+                saved = [[*k.split('|'), v['position'], v['units'], v['entry_price']] for k, v in saved.items()]
+
+            # Rows are [a1, a2, position, units, entry_price]; columns are sliced out into the typed arrays
+            rows = np.asarray(saved, dtype=object).reshape(-1, 5)
+            # Matched by tickers, so editing the watchlist never shifts a position onto another pair
+            slots = [PAIR_INDEX.get((a1, a2), -1) for a1, a2 in rows[:, :2]]
+            known = np.array(slots, dtype=np.int64) >= 0
+            idx = np.array(slots, dtype=np.int64)[known]
+            st.session_state.positions[idx] = rows[known, 2].astype(np.int8)
+            st.session_state.held_units[idx] = rows[known, 3].astype(np.int64)
+            st.session_state.entry_prices[idx] = rows[known, 4].astype(np.float64)
         else:
             raise ValueError("Empty cell")
     except Exception:
         # If the cell is empty or broken, start fresh
         st.session_state.portfolio = 1000000.0
+        reset_positions()
 
-        # We define pairs later, but we need to initialize them here
-        st.session_state.states = {}
-
-        # Load Ledger
+        # Load Ledger: one raw values read, rows kept as lists in to_ledger_row column order
     try:
-        records = ledger_tab.get_all_records()
-        st.session_state.trade_log = records
+        _header, *rows = ledger_tab.get_values() or [[]]
+        st.session_state.trade_log = rows
     except Exception:
         st.session_state.trade_log = []
 
 
 def save_cloud_state():
     """Pushes your capital and positions up to Google Sheets Cell A1."""
-    str_states = {f"{k[0]}|{k[1]}": v for k, v in st.session_state.states.items()}
+    # One [a1, a2, position, units, entry_price] row per open position; flat pairs are implied
+    open_slots = np.flatnonzero(st.session_state.positions)
     state_data = {
         'portfolio': st.session_state.portfolio,
-        'states': str_states
+        'states': [[*pairs[i], int(st.session_state.positions[i]), int(st.session_state.held_units[i]),
+                    float(st.session_state.entry_prices[i])] for i in open_slots]
     }
     # Dump the entire memory state into a single cell to avoid complex formatting
-    state_tab.update_acell('A1', json.dumps(state_data))
+    payload = json.dumps(state_data, separators=(',', ':'))
 
+    # Skip the API write when the cell already holds exactly this state
+    state_hash = hashlib.blake2b(payload.encode(), digest_size=16).digest()
+    if state_hash == st.session_state.get('_last_state_hash'):
+        return
+    state_tab.update(range_name='A1', values=[[payload]], value_input_option='RAW')
+    st.session_state._last_state_hash = state_hash
 
-def append_to_cloud_ledger(trade_dict):
-    """Adds a new row to the Google Sheets Ledger tab."""
-    # Convert dictionary values to a simple list for Google Sheets
-    row_data = [
+
+def to_ledger_row(trade_dict):
+    """Converts a trade dictionary to a simple list for Google Sheets."""
+    return [
         trade_dict['Time'], trade_dict['Pair'], trade_dict['Asset'],
         trade_dict['Action'], trade_dict['Price'], trade_dict['Qty'], trade_dict['P&L']
     ]
-    ledger_tab.append_row(row_data)
+
+
+LEDGER_ACTION_COL = 3  # Position of 'Action' in to_ledger_row
+
+
+def append_to_cloud_ledger(rows):
+    """Adds all of this cycle's trades to the Google Sheets Ledger tab in one request."""
+    ledger_tab.append_rows(rows, value_input_option="RAW")
 
 
 # ---------------------------------------------------------
@@ -130,10 +168,25 @@ pairs = [
     ('RELIANCE.NS', 'TATAPOWER.NS'), ('RELIANCE.NS', 'ONGC.NS')
 ]
 all_tickers = list(set([ticker for pair in pairs for ticker in pair]))
+PAIR_INDEX = {pair: i for i, pair in enumerate(pairs)}
+PAIR_LABELS = tuple(f"{a1.replace('.NS', '')} / {a2.replace('.NS', '')}" for a1, a2 in pairs)
+# Plotly axis ids of each pair's cell in the 4x4 grid: 'x'/'y' for the first, then 'x2'/'y2', ...
+PAIR_AXES = [(f"x{k if k > 1 else ''}", f"y{k if k > 1 else ''}") for k in range(1, len(pairs) + 1)]
 
 ENTRY_Z = 1.75
 EXIT_Z = 0.0
 TRADE_ALLOCATION = 50000.0
+Z_WINDOW = 20  # Rolling window, in daily bars, for the spread z-score
+PLOT_POINTS = 20  # Most recent full-window z-scores drawn per pair
+
+# Pinned download options shared by the calibration and live fetches: daily bars, one threaded
+# multi-ticker request, no dividend/split columns. Prices stay split/dividend adjusted so a
+# corporate action never shows up as a jump in the spread.
+YF_OPTIONS = dict(interval="1d", threads=True, actions=False, auto_adjust=True, progress=False)
+
+# Hedge ratios survive restarts on disk so a cold boot skips the 1y download
+CALIB_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "calib.json")
+CALIB_TTL_SECONDS = 24 * 60 * 60
 
 
 def format_inr(number):
@@ -155,28 +208,149 @@ def format_inr(number):
 
 if 'portfolio' not in st.session_state:
     load_cloud_state()
-    # Ensure states are mapped to the pairs list if it was an empty boot
-    if not st.session_state.states:
-        st.session_state.states = {pair: {'position': 0, 'units': 0, 'entry_price': 0.0} for pair in pairs}
+
+# Views onto the session arrays: writes below update session state in place
+positions = st.session_state.positions
+held_units = st.session_state.held_units
+entry_prices = st.session_state.entry_prices
 
 
-@st.cache_data
 def calibrate_pairs():
-    hist_data = yf.download(all_tickers, period="1y", progress=False)['Close'].ffill().dropna()
-    calibrated = {}
-    for a1, a2 in pairs:
-        model = sm.OLS(hist_data[a1], hist_data[a2]).fit()
-        calibrated[(a1, a2)] = model.params.iloc[0]
+    hist_data = yf.download(all_tickers, period="1y", **YF_OPTIONS)['Close'].ffill()
+    # A ticker Yahoo dropped comes back missing or all-NaN, so rows are masked per pair, not dropped frame-wide
+    y = hist_data.reindex(columns=[a1 for a1, _ in pairs]).to_numpy()
+    x = hist_data.reindex(columns=[a2 for _, a2 in pairs]).to_numpy()
+    usable = ~(np.isnan(y) | np.isnan(x))
+    # No-intercept OLS slope of a1 on a2 in closed form for every pair at once: (x . y) / (x . x)
+    num = np.where(usable, x * y, 0.0).sum(axis=0)
+    den = np.where(usable, x * x, 0.0).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        betas = num / den
+
+    # None flags a pair with too little history or a degenerate regressor; it is shown but never traded
+    valid = (usable.sum(axis=0) > 50) & np.isfinite(betas)
+    return {pair: float(beta) if ok else None for pair, beta, ok in zip(pairs, betas, valid)}
+
+
+@st.cache_data(ttl=3600)
+def load_calibration():
+    """Returns the hedge ratios from .cache/calib.json while under 24h old, otherwise refits and rewrites it."""
+    try:
+        with open(CALIB_CACHE_PATH) as f:
+            cached = json.load(f)
+        ratios = {tuple(k.split('|')): v for k, v in cached['ratios'].items()}
+        if time.time() - cached['saved_at'] < CALIB_TTL_SECONDS and all(pair in ratios for pair in pairs):
+            return ratios
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass  # Missing, corrupt, wrongly shaped or stale cache: recalibrate below
+
+    calibrated = calibrate_pairs()
+    try:
+        os.makedirs(os.path.dirname(CALIB_CACHE_PATH), exist_ok=True)
+        tmp_path = CALIB_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'saved_at': time.time(), 'ratios': {f"{a1}|{a2}": v for (a1, a2), v in calibrated.items()}}, f)
+        os.replace(tmp_path, CALIB_CACHE_PATH)  # Atomic, so a crash never leaves half a file behind
+    except OSError:
+        pass  # Read-only disk: the in-memory cache above still holds the ratios
     return calibrated
 
 
-calibrated_pairs = calibrate_pairs()
+@st.cache_data(ttl=55)  # Just under the 60s cycle: every rerun sees fresh bars, concurrent tabs share one download
+def fetch_live(tickers_tuple):
+    # reindex: a ticker missing from Yahoo's reply becomes an all-NaN column instead of a KeyError below
+    closes = yf.download(list(tickers_tuple), period="40d", **YF_OPTIONS)['Close']
+    return closes.reindex(columns=list(tickers_tuple)).ffill()
+
+
+calibrated_pairs = load_calibration()
+
+
+# Signal codes returned by compute_signals()
+HOLD, BUY_ASSET1, BUY_ASSET2, SELL = 0, 1, 2, 3
+
+
+@njit(types.Tuple((types.float64[:, :], types.float64[:], types.int64[:]))(
+    types.float64[:, :], types.float64[:, :], types.float64[:], types.int64,
+    types.float64, types.float64, types.int8[:]), cache=True)
+def compute_signals(P1, P2, ratios, W, entry_z, exit_z, positions):
+    """Rolling z-scores of every pair's spread plus its HOLD/BUY/SELL signal, in a single compiled pass."""
+    T, n = P1.shape
+    z_scores = np.full((T, n), np.nan)
+    z_last = np.full(n, np.nan)
+    signal = np.zeros(n, dtype=np.int64)
+
+    for j in range(n):
+        # Centre the spread first so the running sum of squares stays well conditioned
+        shift, valid = 0.0, 0
+        for t in range(T):
+            spread = P1[t, j] - ratios[j] * P2[t, j]
+            if not np.isnan(spread):
+                shift += spread
+                valid += 1
+        if valid > 0:
+            shift /= valid
+
+        # Running sum / sum of squares: add the new bar, drop the one leaving the window (O(T) per pair)
+        total, total_sq, valid = 0.0, 0.0, 0
+        for t in range(T):
+            spread = P1[t, j] - ratios[j] * P2[t, j] - shift
+            if not np.isnan(spread):
+                total += spread
+                total_sq += spread * spread
+                valid += 1
+            if t >= W:
+                old = P1[t - W, j] - ratios[j] * P2[t - W, j] - shift
+                if not np.isnan(old):
+                    total -= old
+                    total_sq -= old * old
+                    valid -= 1
+            if t >= W - 1 and valid == W:  # Like pandas rolling: a window with a missing bar stays NaN
+                var = (total_sq - total * total / W) / (W - 1)  # Sample variance (ddof=1)
+                if var > 0:
+                    z_scores[t, j] = (spread - total / W) / np.sqrt(var)
+                    z_last[j] = z_scores[t, j]
+
+        z = z_last[j]
+        if np.isnan(z):
+            continue
+        if positions[j] == 0:
+            if z < -entry_z:
+                signal[j] = BUY_ASSET1
+            elif z > entry_z:
+                signal[j] = BUY_ASSET2
+        elif (positions[j] == 1 and z > exit_z) or (positions[j] == 2 and z < exit_z):
+            signal[j] = SELL
+
+    return z_scores, z_last, signal
+
+
+@st.cache_resource
+def build_base_fig(pair_labels):
+    """Builds the 4x4 grid, threshold lines, axis settings and one empty line per pair (trace i plots pair i) once;
+    reruns copy it and only fill in x/y/colour."""
+    fig = make_subplots(rows=4, cols=4, subplot_titles=pair_labels)
+    fig.add_traces([
+        go.Scatter(x=[], y=[], mode='lines', line=dict(width=2), xaxis=xaxis, yaxis=yaxis, showlegend=False)
+        for xaxis, yaxis in PAIR_AXES
+    ])
+    thresholds = [(ENTRY_Z, "dash", "red"), (-ENTRY_Z, "dash", "red"), (EXIT_Z, "dot", "gray")]
+    fig.layout.shapes = tuple(
+        dict(type="line", xref=f"{xaxis} domain", x0=0, x1=1, yref=yaxis, y0=level, y1=level,
+             line=dict(dash=dash, color=color, width=1))
+        for xaxis, yaxis in PAIR_AXES for level, dash, color in thresholds
+    )
+    fig.update_yaxes(range=[-3.5, 3.5])
+    fig.update_xaxes(showticklabels=False)
+    fig.update_layout(height=800, margin=dict(l=20, r=20, t=40, b=20), plot_bgcolor='rgba(240,240,240,0.5)')
+    return fig
+
 
 # ---------------------------------------------------------
 # 4. Live Data Fetching & Dashboard UI
 # ---------------------------------------------------------
 timestamp = now_ist.strftime("%Y-%m-%d %H:%M:%S")
-live_data = yf.download(all_tickers, period="40d", progress=False)['Close'].ffill()
+live_data = fetch_live(tuple(sorted(all_tickers)))
 
 with st.sidebar:
     st.header("☁️ Cloud Control Panel")
@@ -193,8 +367,8 @@ st.caption(f"Last updated: {timestamp} IST | Synced with Google Sheets")
 
 col1, col2, col3 = st.columns(3)
 col1.metric("Cloud Capital", format_inr(st.session_state.portfolio))
-col2.metric("Active Pairs", sum(1 for state in st.session_state.states.values() if state['position'] != 0))
-col3.metric("Total Completed Trades", len([t for t in st.session_state.trade_log if t['Action'] == 'SELL']))
+col2.metric("Active Pairs", int(np.count_nonzero(positions)))
+col3.metric("Total Completed Trades", sum(1 for row in st.session_state.trade_log if row[LEDGER_ACTION_COL] == 'SELL'))
 
 st.markdown("---")
 
@@ -202,118 +376,115 @@ st.markdown("---")
 # 5. Core Trading Logic
 # ---------------------------------------------------------
 dynamic_titles = []
-for a1, a2 in pairs:
-    state = st.session_state.states[(a1, a2)]
-    base_title = f"{a1.replace('.NS', '')} / {a2.replace('.NS', '')}"
-    if state['position'] != 0:
-        held_asset = a1.replace('.NS', '') if state['position'] == 1 else a2.replace('.NS', '')
-        base_title += f" | [HOLDING: {state['units']} {held_asset}]"
+for i, ((a1, a2), base_title) in enumerate(zip(pairs, PAIR_LABELS)):
+    if positions[i] != 0:
+        held_asset = a1.replace('.NS', '') if positions[i] == 1 else a2.replace('.NS', '')
+        base_title += f" | [HOLDING: {held_units[i]} {held_asset}]"
     dynamic_titles.append(base_title)
 
-fig = make_subplots(rows=4, cols=4, subplot_titles=dynamic_titles)
+# Z-scores and entry/exit signals for every pair come out of one compiled call
+# An uncalibrated pair's None becomes a NaN ratio, so its spread, z-score and signal all stay NaN / HOLD
+ratios = np.array([calibrated_pairs[pair] for pair in pairs], dtype=np.float64)
+for i in np.flatnonzero(np.isnan(ratios)):
+    st.warning(f"⚠️ Hedge ratio for {PAIR_LABELS[i]} could not be calibrated. Skipping...")
+prices_1 = live_data[[a1 for a1, _ in pairs]].to_numpy(dtype=np.float64)
+prices_2 = live_data[[a2 for _, a2 in pairs]].to_numpy(dtype=np.float64)
+z_scores, z_last, signals = compute_signals(prices_1, prices_2, ratios, Z_WINDOW, ENTRY_Z, EXIT_Z, positions)
+# A 40d pull is only ~27 NSE sessions, so the rows before the first full window are dropped rather than drawn
+# as an empty left half. A NaN that remains (a flat window with var <= 0, or a ticker with no price yet)
+# plots as a gap.
+plot_index = live_data.index[Z_WINDOW - 1:][-PLOT_POINTS:]
+z_tail = z_scores[Z_WINDOW - 1:][-PLOT_POINTS:]
+
+# Copy the shared cached skeleton so per-session data never leaks into it
+fig = go.Figure(build_base_fig(PAIR_LABELS))
+for annotation, title in zip(fig.layout.annotations, dynamic_titles):
+    annotation.text = title
+
 alerts = []
-row, col = 1, 1
 state_changed = False
+pending_ledger_rows = []  # Flushed to Sheets once, after the loop
 
-for asset1, asset2 in pairs:
-    ratio = calibrated_pairs[(asset1, asset2)]
-    spread_series = live_data[asset1] - (ratio * live_data[asset2])
-    sma_series = spread_series.rolling(window=20).mean()
-    std_series = spread_series.rolling(window=20).std().replace(0, np.nan)
-    z_score_series = ((spread_series - sma_series) / std_series).dropna()
-
-    if not z_score_series.empty:
-        current_z = z_score_series.iloc[-1]
-        live_p1 = live_data[asset1].iloc[-1]
-        live_p2 = live_data[asset2].iloc[-1]
+for i, (asset1, asset2) in enumerate(pairs):
+    if not np.isnan(z_last[i]):  # At least one full window
+        live_p1 = prices_1[-1, i]
+        live_p2 = prices_2[-1, i]
 
-        pair_state = st.session_state.states[(asset1, asset2)]
         short_name1, short_name2 = asset1.replace('.NS', ''), asset2.replace('.NS', '')
 
         # --- CLOUD TRADING LOGIC ---
         if MARKET_IS_OPEN:
-            if pair_state['position'] == 0:
-                if current_z < -ENTRY_Z:
-                    units = int(TRADE_ALLOCATION // live_p1)
-                    if units > 0 and st.session_state.portfolio >= (units * live_p1):
-                        st.session_state.portfolio -= (units * live_p1)
-                        st.session_state.states[(asset1, asset2)] = {'position': 1, 'units': units,
-                                                                     'entry_price': live_p1}
-
-                        trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name1,
-                                      'Action': 'BUY', 'Price': round(live_p1, 2), 'Qty': units, 'P&L': 0.0}
-                        st.session_state.trade_log.append(trade_dict)
-                        append_to_cloud_ledger(trade_dict)  # Push to Sheets
-                        alerts.append(f"🚨 BOUGHT {units} {short_name1}")
-                        state_changed = True
-
-                elif current_z > ENTRY_Z:
-                    units = int(TRADE_ALLOCATION // live_p2)
-                    if units > 0 and st.session_state.portfolio >= (units * live_p2):
-                        st.session_state.portfolio -= (units * live_p2)
-                        st.session_state.states[(asset1, asset2)] = {'position': 2, 'units': units,
-                                                                     'entry_price': live_p2}
-
-                        trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name2,
-                                      'Action': 'BUY', 'Price': round(live_p2, 2), 'Qty': units, 'P&L': 0.0}
-                        st.session_state.trade_log.append(trade_dict)
-                        append_to_cloud_ledger(trade_dict)  # Push to Sheets
-                        alerts.append(f"🚨 BOUGHT {units} {short_name2}")
-                        state_changed = True
-
-            elif pair_state['position'] == 1:
-                if current_z > EXIT_Z:
-                    revenue = pair_state['units'] * live_p1
-                    profit = revenue - (pair_state['units'] * pair_state['entry_price'])
-                    st.session_state.portfolio += revenue
+            if signals[i] == BUY_ASSET1:
+                units = int(TRADE_ALLOCATION // live_p1)
+                if units > 0 and st.session_state.portfolio >= (units * live_p1):
+                    st.session_state.portfolio -= (units * live_p1)
+                    positions[i], held_units[i], entry_prices[i] = 1, units, live_p1
 
                     trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name1,
-                                  'Action': 'SELL', 'Price': round(live_p1, 2), 'Qty': pair_state['units'],
-                                  'P&L': round(profit, 2)}
-                    st.session_state.trade_log.append(trade_dict)
-                    append_to_cloud_ledger(trade_dict)  # Push to Sheets
-
-                    st.session_state.states[(asset1, asset2)] = {'position': 0, 'units': 0, 'entry_price': 0.0}
-                    alerts.append(f"🔔 SOLD {short_name1} | Profit: ₹{profit:.2f}")
+                                  'Action': 'BUY', 'Price': round(live_p1, 2), 'Qty': units, 'P&L': 0.0}
+                    ledger_row = to_ledger_row(trade_dict)
+                    st.session_state.trade_log.append(ledger_row)
+                    pending_ledger_rows.append(ledger_row)
+                    alerts.append(f"🚨 BOUGHT {units} {short_name1}")
                     state_changed = True
 
-            elif pair_state['position'] == 2:
-                if current_z < EXIT_Z:
-                    revenue = pair_state['units'] * live_p2
-                    profit = revenue - (pair_state['units'] * pair_state['entry_price'])
-                    st.session_state.portfolio += revenue
+            elif signals[i] == BUY_ASSET2:
+                units = int(TRADE_ALLOCATION // live_p2)
+                if units > 0 and st.session_state.portfolio >= (units * live_p2):
+                    st.session_state.portfolio -= (units * live_p2)
+                    positions[i], held_units[i], entry_prices[i] = 2, units, live_p2
 
                     trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name2,
-                                  'Action': 'SELL', 'Price': round(live_p2, 2), 'Qty': pair_state['units'],
-                                  'P&L': round(profit, 2)}
-                    st.session_state.trade_log.append(trade_dict)
-                    append_to_cloud_ledger(trade_dict)  # Push to Sheets
-
-                    st.session_state.states[(asset1, asset2)] = {'position': 0, 'units': 0, 'entry_price': 0.0}
-                    alerts.append(f"🔔 SOLD {short_name2} | Profit: ₹{profit:.2f}")
+                                  'Action': 'BUY', 'Price': round(live_p2, 2), 'Qty': units, 'P&L': 0.0}
+                    ledger_row = to_ledger_row(trade_dict)
+                    st.session_state.trade_log.append(ledger_row)
+                    pending_ledger_rows.append(ledger_row)
+                    alerts.append(f"🚨 BOUGHT {units} {short_name2}")
                     state_changed = True
 
+            elif signals[i] == SELL and positions[i] == 1:
+                revenue = held_units[i] * live_p1
+                profit = revenue - (held_units[i] * entry_prices[i])
+                st.session_state.portfolio += revenue
+
+                trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name1,
+                              'Action': 'SELL', 'Price': round(live_p1, 2), 'Qty': int(held_units[i]),
+                              'P&L': round(profit, 2)}
+                ledger_row = to_ledger_row(trade_dict)
+                st.session_state.trade_log.append(ledger_row)
+                pending_ledger_rows.append(ledger_row)
+
+                positions[i], held_units[i], entry_prices[i] = 0, 0, 0.0
+                alerts.append(f"🔔 SOLD {short_name1} | Profit: ₹{profit:.2f}")
+                state_changed = True
+
+            elif signals[i] == SELL and positions[i] == 2:
+                revenue = held_units[i] * live_p2
+                profit = revenue - (held_units[i] * entry_prices[i])
+                st.session_state.portfolio += revenue
+
+                trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}", 'Asset': short_name2,
+                              'Action': 'SELL', 'Price': round(live_p2, 2), 'Qty': int(held_units[i]),
+                              'P&L': round(profit, 2)}
+                ledger_row = to_ledger_row(trade_dict)
+                st.session_state.trade_log.append(ledger_row)
+                pending_ledger_rows.append(ledger_row)
+
+                positions[i], held_units[i], entry_prices[i] = 0, 0, 0.0
+                alerts.append(f"🔔 SOLD {short_name2} | Profit: ₹{profit:.2f}")
+                state_changed = True
+
         # --- PLOTTING ---
-        plot_data = z_score_series.tail(20)
-        line_color = 'rgba(0, 200, 0, 1)' if st.session_state.states[(asset1, asset2)][
-                                                 'position'] != 0 else 'rgba(0, 0, 255, 0.7)'
-
-        fig.add_trace(
-            go.Scatter(x=plot_data.index, y=plot_data.values, mode='lines', line=dict(color=line_color, width=2),
-                       showlegend=False), row=row, col=col)
-        fig.add_hline(y=ENTRY_Z, line_dash="dash", line_color="red", line_width=1, row=row, col=col)
-        fig.add_hline(y=-ENTRY_Z, line_dash="dash", line_color="red", line_width=1, row=row, col=col)
-        fig.add_hline(y=EXIT_Z, line_dash="dot", line_color="gray", line_width=1, row=row, col=col)
-        fig.update_yaxes(range=[-3.5, 3.5], row=row, col=col)
-        fig.update_xaxes(showticklabels=False, row=row, col=col)
-
-    col += 1
-    if col > 4:
-        col = 1
-        row += 1
-
-# If memory changed, push the new portfolio state to Google Sheets immediately
+        plot_values = z_tail[:, i]
+        line_color = 'rgba(0, 200, 0, 1)' if positions[i] != 0 else 'rgba(0, 0, 255, 0.7)'
+
+        trace = fig.data[i]
+        trace.x, trace.y = plot_index, plot_values
+        trace.line.color = line_color
+
+# If memory changed, push this cycle's trades and the new portfolio state to Google Sheets together
 if state_changed:
+    append_to_cloud_ledger(pending_ledger_rows)
     save_cloud_state()
 
 # Apply Market Closed Watermark (Visible right now because it's past 3:30 PM IST)
@@ -325,7 +496,6 @@ if not MARKET_IS_OPEN:
         align="center", textangle=-15, showarrow=False
     )
 
-fig.update_layout(height=800, margin=dict(l=20, r=20, t=40, b=20), plot_bgcolor='rgba(240,240,240,0.5)')
 st.plotly_chart(fig, use_container_width=True)
 
 if alerts:
@@ -334,6 +504,3 @@ if alerts:
             st.warning(alert)
         else:
             st.success(alert)
-
-time.sleep(60)
-st.rerun()
\ No newline at end of file
@@ -1,20 +1,21 @@
 import streamlit as st
 import yfinance as yf
+import yfinance_cache as yfc
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
+import bottleneck as bn
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
-import warnings
 import json
 import gspread
+from numba import njit, types
+from streamlit_autorefresh import st_autorefresh
 from google.oauth2.service_account import Credentials
 
-warnings.filterwarnings("ignore")
-
 st.set_page_config(page_title="24/7 Crypto Quant", layout="wide", page_icon="🪙")
 
 # ---------------------------------------------------------
@@ -24,15 +25,39 @@ SHEET_ID = "1Xlf5f1cH0jYSnDweXQmj7tuuuKrPRkA9xlZm4wl8ZWs"
 ENTRY_Z = 1.15
 EXIT_Z = 0.0
 LEG_ALLOCATION = 25000.0
+STARTING_CAPITAL = 1000.0
+
+# Short names and labels are derived once here instead of on every rerun
+Pair = namedtuple('Pair', ['a1', 'a2', 'short1', 'short2', 'label'])
+
+
+def make_pair(a1, a2):
+    short1, short2 = a1.replace('-USD', ''), a2.replace('-USD', '')
+    return Pair(a1, a2, short1, short2, f"{short1}/{short2}")
 
-PAIRS = [
+
+PAIRS = [make_pair(a1, a2) for a1, a2 in [
     ('BTC-USD', 'ETH-USD'), ('SOL-USD', 'AVAX-USD'),
     ('LINK-USD', 'AAVE-USD'), ('DOGE-USD', 'SHIB-USD'),
     ('ADA-USD', 'DOT-USD'), ('LTC-USD', 'BCH-USD'),
     ('HBAR-USD', 'ALGO-USD'), ('XRP-USD', 'XLM-USD')
-]
+]]
+
+PAIR_A1 = [pair.a1 for pair in PAIRS]
+PAIR_A2 = [pair.a2 for pair in PAIRS]
+PAIR_LABELS = tuple(f"{pair.short1} / {pair.short2}" for pair in PAIRS)
+PAIR_INDEX = {pair.label: i for i, pair in enumerate(PAIRS)}
+ALL_TICKERS = list(set(PAIR_A1 + PAIR_A2))
+Z_WINDOW = 20
+LIVE_WINDOW = 40  # Daily bars used for the live z-score, fetched fresh every cycle
+# Plotly axis ids of each pair's subplot in the 2x4 grid: 'x'/'y' for the first, then 'x2'/'y2', ...
+PAIR_AXES = [(f"x{idx if idx > 1 else ''}", f"y{idx if idx > 1 else ''}") for idx in range(1, len(PAIRS) + 1)]
+LEDGER_COLUMNS = ['Time', 'Pair', 'Asset', 'Action', 'Price', 'Qty', 'P&L']
 
-ALL_TICKERS = list(set([ticker for pair in PAIRS for ticker in pair]))
+# crypto_states is a (len(PAIRS), 5) float array; row i is PAIRS[i], columns are below.
+# POS is 0 when flat, 1 for LONG A1 / SHORT A2 and 2 for SHORT A1 / LONG A2.
+POS, U1, EP1, U2, EP2 = 0, 1, 2, 3, 4
+HOLD, ENTER_LONG, ENTER_SHORT, EXIT = 0, 1, 2, 3  # Action codes returned by decide()
 
 
 # ---------------------------------------------------------
@@ -54,119 +79,285 @@ def get_gspread_client():
         return None
 
 
+@st.cache_resource
+def open_worksheets(_client):
+    # Cached so reruns reuse the handles; one worksheets() listing instead of a lookup per tab
+    sheet = _client.open_by_key(SHEET_ID)
+    tabs = {worksheet.title: worksheet for worksheet in sheet.worksheets()}
+    return tabs["Crypto_Ledger"], tabs.get("Crypto_State"), sheet
+
+
 def get_worksheets(client):
     try:
         if client:
-            sheet = client.open_by_key(SHEET_ID)
-            return sheet.worksheet("Crypto_State"), sheet.worksheet("Crypto_Ledger")
+            return open_worksheets(client)
     except Exception as e:
         st.error(f"🚨 Database Error: Could not open the Google Sheet. Details: {e}")
-    return None, None
+    return None, None, None
 
 
 # Initialize Database Connections Safely
 db_client = get_gspread_client()
-state_tab, ledger_tab = get_worksheets(db_client)
+ledger_tab, state_tab, spreadsheet = get_worksheets(db_client)
+
+
+def empty_states():
+    return np.zeros((len(PAIRS), 5), dtype=np.float64)
+
+
+def fill_price(quoted, units):
+    # Ledger prices are rounded to cents and quantities to 5 dp. Whichever pins the fill down tighter
+    # wins: the quote for a handful of units (BTC), LEG_ALLOCATION / units for cheap coins (SHIB).
+    if 0.005 * units < LEG_ALLOCATION * 5e-6 / units:
+        return quoted
+    return LEG_ALLOCATION / units
+
+
+def rebuild_states_from_ledger(records):
+    # Replays the append-only ledger in order: the last ENTER/EXIT per pair decides its position
+    states = empty_states()
+    for record in records:
+        i = PAIR_INDEX.get(record.get('Pair'))
+        if i is None:
+            continue
+        if record.get('Action') == 'EXIT':
+            states[i] = 0.0
+        elif record.get('Action') == 'ENTER':
+            try:
+                p1, p2 = (float(v) for v in str(record['Price']).split('/'))
+                u1, u2 = (float(v) for v in str(record['Qty']).split('/'))
+            except (KeyError, ValueError):
+                continue  # Malformed row, e.g. edited by hand
+            position = 1 if str(record.get('Asset', '')).startswith('LONG') else 2
+            states[i] = (position, u1, fill_price(p1, u1), u2, fill_price(p2, u2))
+    return states
+
+
+def load_capital_offset(rebuilt_capital):
+    # Capital used to live in Crypto_State!A1 as {"portfolio": ...}. On the first cold start after the switch
+    # to ledger-only state, the gap between that figure and the ledger rebuild is saved once as an offset, so
+    # a sheet whose capital was never exactly STARTING_CAPITAL + ledger P&L keeps its balance.
+    if not state_tab:
+        return 0.0
+    cell = state_tab.batch_get(['A1'])[0]
+    raw_data = cell[0][0] if cell and cell[0] else None
+    state_data = json.loads(raw_data) if raw_data else {}
+    if 'capital_offset' in state_data:
+        return float(state_data['capital_offset'])
+    if 'portfolio' not in state_data:
+        return 0.0  # Fresh sheet: the ledger alone is the record
+
+    offset = float(state_data['portfolio']) - rebuilt_capital
+    payload = json.dumps({'capital_offset': offset, 'migrated_portfolio': state_data['portfolio']},
+                         separators=(',', ':'))
+    spreadsheet.values_update(f"{state_tab.title}!A1", params={'valueInputOption': 'RAW'},
+                              body={'values': [[payload]]})
+    return offset
 
 
 def load_cloud_state():
     # 1. Set safe empty defaults first so the app never crashes
-    st.session_state.crypto_portfolio = 1000.0
-    st.session_state.crypto_states = {
-        pair: {'position': 0, 'units_1': 0.0, 'entry_p1': 0.0, 'units_2': 0.0, 'entry_p2': 0.0}
-        for pair in PAIRS
-    }
-    st.session_state.crypto_trade_log = []
+    st.session_state.crypto_portfolio = STARTING_CAPITAL
+    st.session_state.crypto_states = empty_states()
+    st.session_state.crypto_exit_count = 0
+    st.session_state.crypto_active_hedges = 0
 
-    if not state_tab or not ledger_tab:
+    if not ledger_tab:
         st.warning("⚠️ Running in offline/read-only mode. Database connection failed.")
         return
 
-    # 2. Try to pull existing memory
+    # 2. Rebuild memory from the ledger, which is the only thing the bot writes each cycle
     try:
-        raw_data = state_tab.acell('A1').value
-        if raw_data:
-            state_data = json.loads(raw_data)
-            st.session_state.crypto_portfolio = state_data.get('portfolio', 1000.0)
-            loaded_states = {}
-            for k, v in state_data.get('states', {}).items():
-                a1, a2 = k.split('|')
-                loaded_states[(a1, a2)] = v
-            # Prevent KeyError if new pairs were added to the watchlist
-            for pair in PAIRS:
-                if pair in loaded_states:
-                    st.session_state.crypto_states[pair] = loaded_states[pair]
+        unformatted = gspread.utils.ValueRenderOption.unformatted
+        # Pair, Action and P&L are the only columns read in full, in one batched call
+        pair_col, action_col, pnl_col = (
+            [cells[0] if cells else None for cells in column]
+            for column in ledger_tab.batch_get(["B2:B", "D2:D", "G2:G"], value_render_option=unformatted)
+        )
+
+        last_event = {}
+        for idx, (label, action) in enumerate(zip(pair_col, action_col)):
+            last_event[label] = (idx, action)
+
+        # Full rows are needed only for the ENTER that opened each still-open pair
+        open_rows = sorted(idx for label, (idx, action) in last_event.items()
+                           if action == 'ENTER' and label in PAIR_INDEX)
+        ranges = [f"A{idx + 2}:G{idx + 2}" for idx in open_rows]
+        fetched = ledger_tab.batch_get(ranges, value_render_option=unformatted) if ranges else []
+        records = [dict(zip(LEDGER_COLUMNS, row)) for column in fetched for row in column]
+
+        states = rebuild_states_from_ledger(records)
+        realized = sum(v for v in pnl_col if isinstance(v, (int, float)))
+        committed = float(states[:, U1] @ states[:, EP1] + states[:, U2] @ states[:, EP2])  # Flat rows are all zero
+        rebuilt_capital = STARTING_CAPITAL + realized - committed
+        portfolio = rebuilt_capital + load_capital_offset(rebuilt_capital)
+
+        # Nothing reaches the session until every read has succeeded, so a failure leaves the fresh defaults intact
+        st.session_state.crypto_states = states
+        st.session_state.crypto_portfolio = portfolio
+        st.session_state.crypto_exit_count = action_col.count('EXIT')
+        st.session_state.crypto_active_hedges = int(np.count_nonzero(states[:, POS]))
     except Exception as e:
-        st.warning(f"⚠️ Could not load state from Cloud. Starting fresh. Details: {e}")
+        st.warning(f"⚠️ Could not load trade ledger from Cloud. Starting fresh. Details: {e}")
 
-    try:
-        st.session_state.crypto_trade_log = ledger_tab.get_all_records()
-    except Exception as e:
-        st.warning(f"⚠️ Could not load trade ledger from Cloud. Details: {e}")
 
-
-def save_cloud_state():
-    if not state_tab: return
-    try:
-        str_states = {f"{k[0]}|{k[1]}": v for k, v in st.session_state.crypto_states.items()}
-        state_data = {'portfolio': st.session_state.crypto_portfolio, 'states': str_states}
-        state_tab.update_acell('A1', json.dumps(state_data))
-    except Exception as e:
-        st.error(f"⚠️ Failed to save state to Google Sheets! Details: {e}")
+def append_raw(values_2d):
+    # Straight to the values:append endpoint on the ledger's A:G table, which Sheets appends to in
+    # constant time; no worksheet-level append_rows wrapper and no client-side row bookkeeping.
+    # The ledger is the bot's only persisted state, so this is the one write per cycle.
+    # Runs on a worker thread (see main), which has no Streamlit context: errors are raised, not st.error'd.
+    if not spreadsheet or not values_2d: return
+    spreadsheet.values_append(
+        f"{ledger_tab.title}!A:G",
+        params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+        body={'values': values_2d}
+    )
 
 
-def append_to_cloud_ledger(trade_dict):
-    if not ledger_tab: return
-    try:
-        row_data = [
-            trade_dict['Time'], trade_dict['Pair'], trade_dict['Asset'],
-            trade_dict['Action'], trade_dict['Price'], trade_dict['Qty'], trade_dict['P&L']
-        ]
-        ledger_tab.append_row(row_data)
-    except Exception as e:
-        st.error(f"⚠️ Failed to log trade to Google Sheets ledger! Details: {e}")
+def to_ledger_row(trade_dict):
+    return [trade_dict[column] for column in LEDGER_COLUMNS]
 
 
 # ---------------------------------------------------------
 # 3. ROBUST DATA PIPELINE (yFinance Isolations)
 # ---------------------------------------------------------
-@st.cache_data(ttl=3600)  # Automatically wipes cache every hour to prevent ghost data
-def calibrate_pairs_v2(current_pairs, current_tickers):
-    try:
-        hist_data = yf.download(current_tickers, period="6mo", progress=False)['Close'].ffill()
-    except Exception as e:
-        st.error(f"🚨 Failed to download historical data for calibration. Details: {e}")
-        return {}
+@st.cache_data(ttl=3600)  # Calibration history only; refreshed on the same hourly cadence as the fit
+def fetch_history(tickers):
+    # yfinance-cache keeps the 6mo of closed bars on disk, so a restart or an hourly refresh only asks
+    # Yahoo for bars it has not stored yet. Its daily max_age lets the open bar lag by hours, which is
+    # harmless for a 6mo regression but is why live prices do not come from here.
+    # threads=False: yfc's threaded mode forks a process pool, which is unsafe inside the Streamlit server.
+    raw = yfc.download(tickers, period="6mo", progress=False, threads=False, group_by='ticker', adjust_divs=False)
+    return raw.xs('Close', axis=1, level=1).ffill()
 
-    calibrated = {}
-    for a1, a2 in current_pairs:
-        try:
-            pair_data = hist_data[[a1, a2]].dropna()
-            if len(pair_data) > 50:
-                model = sm.OLS(pair_data[a1], pair_data[a2]).fit()
-                calibrated[(a1, a2)] = model.params.iloc[0]
-            else:
-                calibrated[(a1, a2)] = 1.0
-        except Exception:
-            calibrated[(a1, a2)] = 1.0  # Safety fallback
-    return calibrated
+
+@st.cache_data(ttl=55)  # Just under the 60s refresh: every cycle sees the current bar, concurrent tabs share one pull
+def fetch_live(tickers):
+    # One threaded multi-ticker request for the live window; its last row is the price every fill uses
+    return yf.download(tickers, period="40d", progress=False, threads=True)['Close'].ffill()
 
 
-def fetch_live_data(tickers):
+def fetch_market_data(tickers):
     try:
-        live_data = yf.download(tickers, period="40d", progress=False)['Close'].ffill()
-        if live_data.empty:
+        hist_data, live_data = fetch_history(tickers), fetch_live(tickers)
+        if hist_data.empty or live_data.empty:
             raise ValueError("Yahoo Finance returned an empty dataframe.")
-        return live_data
+        return hist_data, live_data
     except Exception as e:
-        st.error(f"🚨 Live Data API Error: Could not fetch current prices. Details: {e}")
-        return None
+        st.error(f"🚨 Market Data API Error: Could not fetch prices. Details: {e}")
+        return None, None
+
+
+@st.cache_data(ttl=3600)  # Automatically wipes cache every hour to prevent ghost data
+def calibrate_pairs_v2(current_pairs, _hist_data):
+    # No-intercept OLS hedge ratio in closed form for every pair at once: beta = sum(xy) / sum(x^2)
+    y = _hist_data.reindex(columns=[pair.a1 for pair in current_pairs]).to_numpy()
+    x = _hist_data.reindex(columns=[pair.a2 for pair in current_pairs]).to_numpy()
+    usable = ~(np.isnan(y) | np.isnan(x))  # Per-pair dropna()
+    num = np.where(usable, x * y, 0.0).sum(axis=0)
+    den = np.where(usable, x * x, 0.0).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        betas = num / den
+
+    # Safety fallback for pairs with too little history or a degenerate regressor; flagged so they aren't traded
+    valid_mask = (usable.sum(axis=0) > 50) & np.isfinite(betas)
+    ratio_vec = np.where(valid_mask, betas, 1.0)
+    return ratio_vec, valid_mask
 
 
 def format_usd(number):
     return f"${number:,.2f}"
 
 
+def completed_bar_stats(prices_1, prices_2, ratio_vec, key):
+    # Every bar but the live one is final, so its z history and the running sums of the last
+    # Z_WINDOW - 1 spreads are computed once per closed bar and reused by every tick until the next.
+    roll = st.session_state.get('crypto_roll')
+    if roll is not None and roll['key'] == key:
+        return roll
+
+    history = prices_1[:-1] - ratio_vec * prices_2[:-1]
+    if len(history) >= Z_WINDOW:
+        sma = bn.move_mean(history, window=Z_WINDOW, axis=0)
+        std = bn.move_std(history, window=Z_WINDOW, axis=0, ddof=1)
+        # Zero-std guard fused into the divide: flat windows stay NaN without a masked copy of std
+        z_hist = np.divide(history - sma, std, out=np.full_like(history, np.nan), where=std != 0)
+    else:
+        z_hist = np.full_like(history, np.nan)  # bottleneck rejects a window longer than the series
+    window = history[-(Z_WINDOW - 1):]
+    if len(window) < Z_WINDOW - 1:
+        window = np.full((Z_WINDOW - 1, len(ratio_vec)), np.nan)  # Not enough bars for a live z yet
+
+    # Sums are taken around the window mean so sum-of-squares stays well conditioned at BTC prices
+    shift = window.mean(axis=0)
+    deviations = window - shift
+    roll = {
+        'key': key,
+        'z_hist': z_hist,
+        'shift': shift,
+        'sum': deviations.sum(axis=0),
+        'sumsq': (deviations * deviations).sum(axis=0),
+    }
+    st.session_state.crypto_roll = roll
+    return roll
+
+
+def live_z_scores(roll, live_spread):
+    # O(1) per pair: fold the live spread into the cached window sums, sample (ddof=1) variance
+    d = live_spread - roll['shift']
+    total = roll['sum'] + d
+    var = (roll['sumsq'] + d * d - total * total / Z_WINDOW) / (Z_WINDOW - 1)
+    std = np.sqrt(np.fmax(var, 0.0))  # fmax also maps a NaN variance to 0, i.e. to a NaN z below
+    return np.divide(d - total / Z_WINDOW, std, out=np.full_like(std, np.nan), where=std != 0)
+
+
+# Typed signature: compiled when the module is imported (and cached to disk), never on a live tick
+@njit(types.Tuple((types.float64, types.int64, types.float64, types.float64, types.float64))(
+    types.int64, types.float64, types.float64, types.float64, types.float64, types.float64, types.float64,
+    types.float64[:, ::1], types.float64, types.float64, types.float64), cache=True)
+def decide(i, z, p1, p2, units_1, units_2, cost, states, portfolio, entry_z, exit_z):
+    # One pair's ENTER/EXIT decision; mutates states[i] and returns
+    # (new_portfolio, action, units_1, units_2, realized_pnl).
+    # units_1/units_2/cost are this pair's entry sizing, computed for every pair at once by the caller.
+    state = states[i]
+    if state[POS] == 0:
+        if z < -entry_z or z > entry_z:
+            if portfolio >= cost:
+                action = ENTER_LONG if z < -entry_z else ENTER_SHORT
+                state[POS] = action
+                state[U1], state[EP1], state[U2], state[EP2] = units_1, p1, units_2, p2
+                return portfolio - cost, action, units_1, units_2, 0.0
+
+    elif (state[POS] == 1 and z > exit_z) or (state[POS] == 2 and z < exit_z):
+        # Long A1 / short A2 earns the A1 move minus the A2 move; the mirrored hedge earns the opposite.
+        # Booked at the cents the ledger records, so a cold-start rebuild from its P&L column lands on this capital.
+        side = 1.0 if state[POS] == 1 else -1.0
+        total_profit = round(side * ((p1 - state[EP1]) * state[U1] - (p2 - state[EP2]) * state[U2]), 2)
+
+        portfolio += (state[U1] * state[EP1]) + (state[U2] * state[EP2]) + total_profit
+        state[:] = 0.0
+        return portfolio, EXIT, 0.0, 0.0, total_profit
+
+    return portfolio, HOLD, 0.0, 0.0, 0.0
+
+
+@st.cache_resource
+def build_base_fig(pair_labels):
+    # Static grid, threshold lines and axes are built once; reruns copy this and only add traces
+    fig = make_subplots(rows=2, cols=4, subplot_titles=pair_labels)
+    # Every threshold line as a plain shape dict, assigned in one go instead of 24 add_hline calls
+    thresholds = [(ENTRY_Z, "dash", "red"), (-ENTRY_Z, "dash", "red"), (EXIT_Z, "dot", "gray")]
+    fig.layout.shapes = tuple(
+        dict(type="line", xref=f"{xaxis} domain", x0=0, x1=1, yref=yaxis, y0=level, y1=level,
+             line=dict(dash=dash, color=color, width=1))
+        for xaxis, yaxis in PAIR_AXES for level, dash, color in thresholds
+    )
+    fig.update_yaxes(range=[-3.5, 3.5])
+    fig.update_xaxes(showticklabels=False)
+    fig.update_layout(height=500, margin=dict(l=20, r=20, t=40, b=20), plot_bgcolor='rgba(240,240,240,0.5)')
+    return fig
+
+
 # ---------------------------------------------------------
 # 4. MAIN EXECUTION LOOP (Blast Radius Containment)
 # ---------------------------------------------------------
@@ -174,20 +365,22 @@ def main():
     if 'crypto_portfolio' not in st.session_state:
         load_cloud_state()
 
-    calibrated_pairs = calibrate_pairs_v2(PAIRS, ALL_TICKERS)
-
-    if not calibrated_pairs:
-        st.stop()  # Gracefully halt UI if calibration completely fails
-
     utc_now = datetime.now(pytz.utc)
     timestamp = utc_now.strftime("%Y-%m-%d %H:%M:%S UTC")
 
-    # Live Data Fetch with Retry Logic
-    live_data = fetch_live_data(ALL_TICKERS)
+    # Market Data Fetch with Retry Logic
+    hist_data, live_data = fetch_market_data(ALL_TICKERS)
     if live_data is None:
         st.warning("⏳ Market data feed down. Retrying in 60 seconds...")
-        time.sleep(60)
-        st.rerun()
+        st.stop()
+
+    # ratio_vec[i] / valid_mask[i] line up with PAIRS[i]
+    ratio_vec, valid_mask = calibrate_pairs_v2(PAIRS, hist_data)
+
+    if not valid_mask.any():
+        st.stop()  # Gracefully halt UI if calibration completely fails
+
+    live_data = live_data.tail(LIVE_WINDOW)
 
     with st.sidebar:
         st.header("⚡ 24/7 Crypto Hedge Fund")
@@ -199,178 +392,132 @@ def main():
 
     col1, col2, col3 = st.columns(3)
     col1.metric("Cloud Capital (USD)", format_usd(st.session_state.crypto_portfolio))
-    col2.metric("Active Hedges", sum(1 for state in st.session_state.crypto_states.values() if state['position'] != 0))
-    col3.metric("Total Completed Trades", len([t for t in st.session_state.crypto_trade_log if t['Action'] == 'EXIT']))
+    # Running counters, kept in step with every ENTER/EXIT so reruns never walk the states or the log
+    col2.metric("Active Hedges", st.session_state.crypto_active_hedges)
+    col3.metric("Total Completed Trades", st.session_state.crypto_exit_count)
 
     st.markdown("---")
 
+    states = st.session_state.crypto_states
+
     dynamic_titles = []
-    for a1, a2 in PAIRS:
-        state = st.session_state.crypto_states.get((a1, a2), {'position': 0})
-        base_title = f"{a1.replace('-USD', '')} / {a2.replace('-USD', '')}"
-        if state['position'] == 1:
-            base_title += f" | [LONG {a1.replace('-USD', '')} / SHORT {a2.replace('-USD', '')}]"
-        elif state['position'] == 2:
-            base_title += f" | [SHORT {a1.replace('-USD', '')} / LONG {a2.replace('-USD', '')}]"
+    for i, (pair, base_title) in enumerate(zip(PAIRS, PAIR_LABELS)):
+        if states[i, POS] == 1:
+            base_title += f" | [LONG {pair.short1} / SHORT {pair.short2}]"
+        elif states[i, POS] == 2:
+            base_title += f" | [SHORT {pair.short1} / LONG {pair.short2}]"
         dynamic_titles.append(base_title)
 
-    fig = make_subplots(rows=2, cols=4, subplot_titles=dynamic_titles)
+    # --- VECTORIZED Z-SCORES ---
+    # (T, len(PAIRS)) price matrices; only the live bar's z is recomputed on a tick
+    prices_1 = live_data.reindex(columns=PAIR_A1).to_numpy()
+    prices_2 = live_data.reindex(columns=PAIR_A2).to_numpy()
+    # A new closed bar, a recalibration or a revised last close invalidates the cached sums
+    roll_key = (live_data.index[-2] if len(live_data) > 1 else None, ratio_vec.tobytes(),
+                prices_1[-2:-1].tobytes(), prices_2[-2:-1].tobytes())
+    roll = completed_bar_stats(prices_1, prices_2, ratio_vec, roll_key)
+    z_live = live_z_scores(roll, prices_1[-1] - ratio_vec * prices_2[-1])
+    z_scores = np.vstack([roll['z_hist'], z_live])
+
+    # Everything the pair loop reads comes out of the frame once: newest z and prices, and the plotted tail
+    valid = ~np.isnan(z_scores)
+    last_valid_row = len(z_scores) - 1 - valid[::-1].argmax(axis=0)
+    current_zs = z_scores[last_valid_row, np.arange(len(PAIRS))]  # NaN only when a pair has no z at all
+    live_p1s, live_p2s = prices_1[-1], prices_2[-1]
+    # Entry sizing for every pair in one pass; only a pair that actually enters uses its slot
+    entry_units_1 = np.round(LEG_ALLOCATION / live_p1s, 5)
+    entry_units_2 = np.round(LEG_ALLOCATION / live_p2s, 5)
+    entry_costs = entry_units_1 * live_p1s + entry_units_2 * live_p2s
+    has_live = np.isin(PAIR_A1, live_data.columns) & np.isin(PAIR_A2, live_data.columns)
+    plot_index = live_data.index[-20:]
+    z_tail = z_scores[-20:]  # Prices are forward-filled, so NaNs here are warm-up gaps at the left edge
+
+    # Copy the shared cached skeleton so per-session traces never leak into it
+    fig = go.Figure(build_base_fig(PAIR_LABELS))
+    for annotation, title in zip(fig.layout.annotations, dynamic_titles):
+        annotation.text = title
+
+    scatters = []
     alerts = []
-    row, col = 1, 1
-    state_changed = False
+    pending_ledger_rows = []
 
-    for asset1, asset2 in PAIRS:
+    for i, pair in enumerate(PAIRS):
         # --- BLAST RADIUS CONTAINMENT ---
         # Wrapping individual pairs in a try/except so one bad coin doesn't kill the loop
         try:
-            if (asset1, asset2) not in calibrated_pairs:
+            if not valid_mask[i]:
+                st.warning(f"⚠️ Hedge ratio for {pair.label} could not be calibrated. Skipping...")
                 continue
 
-            ratio = calibrated_pairs[(asset1, asset2)]
-
-            if asset1 not in live_data.columns or asset2 not in live_data.columns:
-                st.warning(f"⚠️ Live data missing for {asset1} or {asset2}. Skipping...")
+            if not has_live[i]:
+                st.warning(f"⚠️ Live data missing for {pair.a1} or {pair.a2}. Skipping...")
                 continue
 
-            spread_series = live_data[asset1] - (ratio * live_data[asset2])
-            sma_series = spread_series.rolling(window=20).mean()
-            std_series = spread_series.rolling(window=20).std().replace(0, np.nan)
-            z_score_series = ((spread_series - sma_series) / std_series).dropna()
-
-            if not z_score_series.empty:
-                current_z = float(z_score_series.iloc[-1])
-                live_p1 = float(live_data[asset1].iloc[-1])
-                live_p2 = float(live_data[asset2].iloc[-1])
+            if not np.isnan(current_zs[i]):
+                current_z = float(current_zs[i])
+                live_p1 = float(live_p1s[i])
+                live_p2 = float(live_p2s[i])
 
                 # Check for corrupted math (NaNs)
                 if np.isnan(current_z) or np.isnan(live_p1) or np.isnan(live_p2):
                     continue
 
-                pair_state = st.session_state.crypto_states.get((asset1, asset2),
-                                                                {'position': 0, 'units_1': 0.0, 'entry_p1': 0.0,
-                                                                 'units_2': 0.0, 'entry_p2': 0.0})
-                short_name1, short_name2 = asset1.replace('-USD', ''), asset2.replace('-USD', '')
                 print(
-                    f"[{timestamp}] 🔎 SCAN: {short_name1}/{short_name2} | Z: {current_z:.2f} | {short_name1}: {format_usd(live_p1)} | {short_name2}: {format_usd(live_p2)}")
-
-                if pair_state['position'] == 0:
-                    if current_z < -ENTRY_Z:
-                        units_1 = round(LEG_ALLOCATION / live_p1, 5)
-                        units_2 = round(LEG_ALLOCATION / live_p2, 5)
-                        cost = (units_1 * live_p1) + (units_2 * live_p2)
-
-                        if st.session_state.crypto_portfolio >= cost:
-                            st.session_state.crypto_portfolio -= cost
-                            st.session_state.crypto_states[(asset1, asset2)] = {
-                                'position': 1, 'units_1': units_1, 'entry_p1': live_p1, 'units_2': units_2,
-                                'entry_p2': live_p2
-                            }
-
-                            trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}",
-                                          'Asset': "LONG A1 / SHORT A2", 'Action': 'ENTER',
-                                          'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': f"{units_1}/{units_2}",
-                                          'P&L': 0.0}
-                            st.session_state.crypto_trade_log.append(trade_dict)
-                            append_to_cloud_ledger(trade_dict)
-                            alerts.append(f"🚨 ENTERED HEDGE: Long {short_name1} / Short {short_name2}")
-                            state_changed = True
-
-                    elif current_z > ENTRY_Z:
-                        units_1 = round(LEG_ALLOCATION / live_p1, 5)
-                        units_2 = round(LEG_ALLOCATION / live_p2, 5)
-                        cost = (units_1 * live_p1) + (units_2 * live_p2)
-
-                        if st.session_state.crypto_portfolio >= cost:
-                            st.session_state.crypto_portfolio -= cost
-                            st.session_state.crypto_states[(asset1, asset2)] = {
-                                'position': 2, 'units_1': units_1, 'entry_p1': live_p1, 'units_2': units_2,
-                                'entry_p2': live_p2
-                            }
-
-                            trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}",
-                                          'Asset': "SHORT A1 / LONG A2", 'Action': 'ENTER',
-                                          'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': f"{units_1}/{units_2}",
-                                          'P&L': 0.0}
-                            st.session_state.crypto_trade_log.append(trade_dict)
-                            append_to_cloud_ledger(trade_dict)
-                            alerts.append(f"🚨 ENTERED HEDGE: Short {short_name1} / Long {short_name2}")
-                            state_changed = True
-
-                elif pair_state['position'] == 1:
-                    if current_z > EXIT_Z:
-                        profit_1 = (live_p1 - pair_state['entry_p1']) * pair_state['units_1']
-                        profit_2 = (pair_state['entry_p2'] - live_p2) * pair_state['units_2']
-                        total_profit = profit_1 + profit_2
-
-                        st.session_state.crypto_portfolio += (pair_state['units_1'] * pair_state['entry_p1']) + (
-                                pair_state['units_2'] * pair_state['entry_p2']) + total_profit
-
-                        trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}",
-                                      'Asset': "CLOSED HEDGE",
-                                      'Action': 'EXIT', 'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': "-",
-                                      'P&L': round(total_profit, 2)}
-                        st.session_state.crypto_trade_log.append(trade_dict)
-                        append_to_cloud_ledger(trade_dict)
-
-                        st.session_state.crypto_states[(asset1, asset2)] = {'position': 0, 'units_1': 0.0,
-                                                                            'entry_p1': 0.0,
-                                                                            'units_2': 0.0, 'entry_p2': 0.0}
-                        alerts.append(
-                            f"🔔 CLOSED HEDGE {short_name1}/{short_name2} | Profit: {format_usd(total_profit)}")
-                        state_changed = True
-
-                elif pair_state['position'] == 2:
-                    if current_z < EXIT_Z:
-                        profit_1 = (pair_state['entry_p1'] - live_p1) * pair_state['units_1']
-                        profit_2 = (live_p2 - pair_state['entry_p2']) * pair_state['units_2']
-                        total_profit = profit_1 + profit_2
-
-                        st.session_state.crypto_portfolio += (pair_state['units_1'] * pair_state['entry_p1']) + (
-                                pair_state['units_2'] * pair_state['entry_p2']) + total_profit
-
-                        trade_dict = {'Time': timestamp, 'Pair': f"{short_name1}/{short_name2}",
-                                      'Asset': "CLOSED HEDGE",
-                                      'Action': 'EXIT', 'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': "-",
-                                      'P&L': round(total_profit, 2)}
-                        st.session_state.crypto_trade_log.append(trade_dict)
-                        append_to_cloud_ledger(trade_dict)
-
-                        st.session_state.crypto_states[(asset1, asset2)] = {'position': 0, 'units_1': 0.0,
-                                                                            'entry_p1': 0.0,
-                                                                            'units_2': 0.0, 'entry_p2': 0.0}
-                        alerts.append(
-                            f"🔔 CLOSED HEDGE {short_name1}/{short_name2} | Profit: {format_usd(total_profit)}")
-                        state_changed = True
+                    f"[{timestamp}] 🔎 SCAN: {pair.label} | Z: {current_z:.2f} | {pair.short1}: {format_usd(live_p1)} | {pair.short2}: {format_usd(live_p2)}")
+
+                # Entry/exit arithmetic runs in the compiled kernel; only bookkeeping for a trade stays in Python
+                st.session_state.crypto_portfolio, action, units_1, units_2, total_profit = decide(
+                    i, current_z, live_p1, live_p2, entry_units_1[i], entry_units_2[i], entry_costs[i],
+                    states, st.session_state.crypto_portfolio, ENTRY_Z, EXIT_Z)
+
+                if action == ENTER_LONG or action == ENTER_SHORT:
+                    if action == ENTER_LONG:
+                        asset, alert = "LONG A1 / SHORT A2", f"Long {pair.short1} / Short {pair.short2}"
+                    else:
+                        asset, alert = "SHORT A1 / LONG A2", f"Short {pair.short1} / Long {pair.short2}"
+
+                    trade_dict = {'Time': timestamp, 'Pair': pair.label,
+                                  'Asset': asset, 'Action': 'ENTER',
+                                  'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': f"{units_1}/{units_2}",
+                                  'P&L': 0.0}
+                    st.session_state.crypto_active_hedges += 1
+                    pending_ledger_rows.append(to_ledger_row(trade_dict))
+                    alerts.append(f"🚨 ENTERED HEDGE: {alert}")
+
+                elif action == EXIT:
+                    trade_dict = {'Time': timestamp, 'Pair': pair.label,
+                                  'Asset': "CLOSED HEDGE",
+                                  'Action': 'EXIT', 'Price': f"{live_p1:.2f}/{live_p2:.2f}", 'Qty': "-",
+                                  'P&L': round(total_profit, 2)}
+                    st.session_state.crypto_exit_count += 1
+                    st.session_state.crypto_active_hedges -= 1
+                    pending_ledger_rows.append(to_ledger_row(trade_dict))
+                    alerts.append(
+                        f"🔔 CLOSED HEDGE {pair.label} | Profit: {format_usd(total_profit)}")
 
             # --- PLOTTING ---
-            plot_data = z_score_series.tail(20)
-            line_color = 'rgba(0, 200, 0, 1)' if st.session_state.crypto_states.get((asset1, asset2), {}).get(
-                'position', 0) != 0 else 'rgba(0, 0, 255, 0.7)'
-
-            fig.add_trace(
-                go.Scatter(x=plot_data.index, y=plot_data.values, mode='lines', line=dict(color=line_color, width=2),
-                           showlegend=False), row=row, col=col)
-            fig.add_hline(y=ENTRY_Z, line_dash="dash", line_color="red", line_width=1, row=row, col=col)
-            fig.add_hline(y=-ENTRY_Z, line_dash="dash", line_color="red", line_width=1, row=row, col=col)
-            fig.add_hline(y=EXIT_Z, line_dash="dot", line_color="gray", line_width=1, row=row, col=col)
-            fig.update_yaxes(range=[-3.5, 3.5], row=row, col=col)
-            fig.update_xaxes(showticklabels=False, row=row, col=col)
+            line_color = 'rgba(0, 200, 0, 1)' if states[i, POS] != 0 else 'rgba(0, 0, 255, 0.7)'
+
+            xaxis, yaxis = PAIR_AXES[i]
+            scatters.append(
+                go.Scatter(x=plot_index, y=z_tail[:, i], mode='lines', line=dict(color=line_color, width=2),
+                           xaxis=xaxis, yaxis=yaxis, showlegend=False))
 
         except Exception as e:
             # If a single pair math fails, show a silent warning but DO NOT crash the app
-            st.warning(f"⚠️ Calculation error on {asset1}/{asset2}. Skipping this cycle. Details: {e}")
+            st.warning(f"⚠️ Calculation error on {pair.a1}/{pair.a2}. Skipping this cycle. Details: {e}")
 
-        # Grid Logic
-        col += 1
-        if col > 4:
-            col = 1
-            row += 1
+    # The Sheets write is pure network wait, so it runs on a worker thread while the chart is built and sent
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        ledger_write = pool.submit(append_raw, pending_ledger_rows)
 
-    if state_changed:
-        save_cloud_state()
+        fig.add_traces(scatters)
+        st.plotly_chart(fig, width='stretch')
 
-    fig.update_layout(height=500, margin=dict(l=20, r=20, t=40, b=20), plot_bgcolor='rgba(240,240,240,0.5)')
-    st.plotly_chart(fig, width='stretch')
+        try:
+            ledger_write.result()
+        except Exception as e:
+            st.error(f"⚠️ Failed to log trades to Google Sheets ledger! Details: {e}")
 
     if alerts:
         for alert in alerts:
@@ -379,18 +526,15 @@ def main():
             else:
                 st.success(alert)
 
-    time.sleep(60)
-    st.rerun()
-
 
 # ---------------------------------------------------------
 # 5. THE GLOBAL SAFETY NET
 # ---------------------------------------------------------
 if __name__ == "__main__":
+    # The browser schedules the next cycle in 60s, so no server thread sleeps while holding the session
+    st_autorefresh(interval=60_000, key="crypto_tick")
     try:
         main()
     except Exception as e:
-        # If the absolute worst happens, catch it, display the error gracefully, and retry in 60s
-        st.error(f"🚨 FATAL APPLICATION ERROR: {e}")
-        time.sleep(60)
-        st.rerun()
\ No newline at end of file
+        # If the absolute worst happens, catch it and display the error gracefully; the autorefresh retries in 60s
+        st.error(f"🚨 FATAL APPLICATION ERROR: {e}")
\ No newline at end of file